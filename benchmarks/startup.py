@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Measures how long the command line takes to start up, and checks the heavy dependencies are not imported until they
+are needed. Run it with the package importable, e.g. after pip install -e .
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'duplicateimagefinder')
+
+# Modules that should only be imported once a scan actually starts
+HEAVY_MODULES = ('PIL', 'blitzdb', 'tqdm')
+
+
+def best_time(command, runs):
+    """
+    Fastest wall clock time of a few runs of the command, in milliseconds
+    """
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(runs):
+            started = time.time()
+            subprocess.check_call(command, cwd=PACKAGE_DIR, stdout=devnull)
+            elapsed = (time.time() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    interpreter = best_time([sys.executable, '-c', 'pass'], runs)
+    help = best_time([sys.executable, 'app.py', '--help'], runs)
+    imported = subprocess.check_output(
+        [sys.executable, '-c', 'import sys, app; print " ".join(m for m in {} if m in sys.modules)'.format(HEAVY_MODULES)],
+        cwd=PACKAGE_DIR).strip()
+
+    print 'interpreter startup:  {:.1f} ms'.format(interpreter)
+    print 'app.py --help:        {:.1f} ms ({:.1f} ms over the interpreter)'.format(help, help - interpreter)
+    print 'imported by app.py:   {}'.format(imported or 'none of ' + ', '.join(HEAVY_MODULES))
+
+    if imported:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,53 +2,116 @@
 
 import argparse
 from functools import partial
-from multiprocessing import Pool, cpu_count
+from itertools import islice
+from multiprocessing import Pool, Semaphore, cpu_count
+import shutil
 import time
 
-from blitzdb import FileBackend, Document
-from PIL import Image
-from tqdm import *
-
 from __init__ import *
+from autotune import Autotuner, ConcurrencyLimit, MAX_WORKERS_PER_CPU
 from enums import *
+from filters import FileFilter
 from output_formats import outputter_for_format
-from output_formats.base import OutputRecord
+from output_formats.base import OutputRecord, LinkedRecord
+from progress import ProgressTracker
+from watchdog import TaskWatchdog
 from utils import *
 
 
-class ImageHash(Document):
-    pass
-
-
 class ImageUtils(object):
 
-    # In-memory hashes that we've encountered during the scan
+    # In-memory hashes that we've encountered during the scan, keyed by file identity (device, inode)
     saved_hashes = dict()
 
+    # Every path seen during the scan for each file identity, so hard links share one cache entry
+    file_aliases = dict()
+
     backend_lock = Lock()
-    persistent_store = FileBackend("hashes.db")
-    persistent_store.create_index(ImageHash, 'name')
 
-    # For accurate ETA estimates, track how many new hashes were completed
-    new_hash_count = 0
+    # Location of the hash cache, it is opened on first use so startup doesn't pay for it
+    cache_path = "hashes.db"
+    persistent_store = None
+
+    # Limits on hashing a single file, files going over them are quarantined. Set before the workers are forked.
+    task_timeout = 0
+    max_pixels = 0
+    max_memory = 0
+
+    # Cached records from an older version of the hash get recalculated
+    hash_version = 3
+
+    # New records are committed to the cache in batches, after this many records or seconds, whichever comes first
+    checkpoint_records = 1000
+    checkpoint_seconds = 300
+    uncommitted_count = 0
+    last_checkpoint = time.time()
+
+    @classmethod
+    def store(cls):
+        """
+        Opens the hash cache the first time it is needed
+        """
+        if cls.persistent_store is None:
+            from cache import CacheBackend
+            from documents import ImageHash, NotImage, Quarantine
+            cls.recover_compaction()
+            cls.persistent_store = CacheBackend(cls.cache_path)
+            cls.persistent_store.create_index(ImageHash, 'name')
+            cls.persistent_store.create_index(NotImage, 'name')
+            cls.persistent_store.create_index(Quarantine, 'name')
+            if cls.persistent_store.recover(ImageHash, NotImage, Quarantine):
+                print "Repaired the cache indexes after an interrupted checkpoint"
+        return cls.persistent_store
+
+    @classmethod
+    def recover_compaction(cls):
+        """
+        Cleans up after a compaction that was interrupted while swapping the compacted store in. If the cache itself is
+        missing the old store is put back, otherwise the leftovers of the swap are deleted.
+        """
+        compact_path, old_path = cls.cache_path + '.compact', cls.cache_path + '.old'
+        if not os.path.exists(cls.cache_path) and os.path.exists(old_path):
+            print "Restoring the cache from an interrupted cleanup"
+            os.rename(old_path, cls.cache_path)
+        shutil.rmtree(compact_path, ignore_errors=True)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def checkpoint(cls, force=False):
+        """
+        Commits the records saved since the last checkpoint, if enough have built up or enough time has passed.
+        Every commit rewrites the cache indexes in full, so checkpointing a large cache often gets expensive.
+        """
+        cls.backend_lock.acquire()
+        try:
+            due = ((cls.checkpoint_records and cls.uncommitted_count >= cls.checkpoint_records) or
+                   (cls.checkpoint_seconds and time.time() - cls.last_checkpoint >= cls.checkpoint_seconds))
+            if cls.uncommitted_count and (force or due):
+                cls.store().commit()
+                cls.uncommitted_count = 0
+                cls.last_checkpoint = time.time()
+        finally:
+            cls.backend_lock.release()
 
     @classmethod
     def lookup_file(cls, filename):
         """
         Check the database for images with this file path
         """
+        from documents import ImageHash
+        filename = os.path.abspath(filename)
         try:
-            return cls.persistent_store.get(ImageHash, {'name': filename})
+            return cls.store().get(ImageHash, {'name': filename})
         except ImageHash.DoesNotExist:
             pass
         except ImageHash.MultipleDocumentsReturned:
             cls.backend_lock.acquire()
             print "Multiple cache entries found for {}".format(filename)
             print "Trying to clean it up, but it problem persist you may need to delete the cache."
-            entries = cls.persistent_store.filter(ImageHash, {'name': filename})
+            entries = cls.store().filter(ImageHash, {'name': filename})
             print "Deleting {} entries".format(len(entries))
             entries.delete()
-            cls.persistent_store.commit()
+            cls.store().commit()
             cls.backend_lock.release()
             pass
         return None
@@ -60,58 +123,315 @@ class ImageUtils(object):
 
         Since this method gets called in the parent thread as a callback to when workers finish calculating a
         hash, we have no way of knowing whether it is new or not so this method checks the last modified time
-        stamp and only does the save if it is stale.
+        stamp and only does the save if it is stale. Returns whether the hash was 'new', 'cached', 'failed' or
+        'quarantined'.
         """
-        if key is None or value is None:
-            return
+        from documents import ImageHash
+        if key is None:
+            return 'failed'
 
-        current_mtime = os.stat(key).st_mtime
+        try:
+            current_mtime = os.stat(key).st_mtime
+        except OSError:
+            # File went away while it was being hashed
+            return 'failed'
+
+        if isinstance(value, Quarantined):
+            cls.quarantine(key, value.reason, value.limit, value.value, current_mtime)
+            return 'quarantined'
+
+        # Remember files that turned out not to be images so later runs don't send them to the workers again
+        if value == NOT_AN_IMAGE:
+            cls.save_non_image(key, 'decode', current_mtime)
+            return 'failed'
+        if value is None:
+            return 'failed'
         should_save_record = True
 
-        # Delete existing record if it exist because file based db doesn't support updating
+        # Delete existing record if it exist because file based db doesn't support updating. The delete and the
+        # new record are committed together at the next checkpoint so a crash can't lose the old hash alone.
         i = cls.lookup_file(key)
         if i:
-            if i.created != current_mtime:
+            if i.created != current_mtime or i.attributes.get('version') != cls.hash_version:
                 cls.backend_lock.acquire()
-                cls.persistent_store.delete(i)
-                cls.persistent_store.commit()
+                cls.store().delete(i)
                 cls.backend_lock.release()
             else:
                 should_save_record = False
 
         # Save new record
         if should_save_record:
-            r = ImageHash({'name': key, 'hash': value, 'created': os.stat(key).st_mtime})
+            r = ImageHash({'name': os.path.abspath(key), 'hash': value[0], 'variants': value[1],
+                           'version': cls.hash_version, 'created': current_mtime})
             cls.backend_lock.acquire()
-            cls.persistent_store.save(r)
+            cls.store().save(r)
+            cls.uncommitted_count += 1
             cls.backend_lock.release()
-            cls.new_hash_count += 1
+            cls.checkpoint()
+
+        cls.saved_hashes[file_identity(key)] = value
+        return 'new' if should_save_record else 'cached'
+
+    @classmethod
+    def is_known_non_image(cls, filename, sniff=True):
+        """
+        Check the database for a record that this file, as it is now, could not be read as an image. Files that were
+        only rejected by sniffing their first bytes don't count when sniffing is turned off.
+        """
+        from documents import NotImage
+        try:
+            i = cls.store().get(NotImage, {'name': os.path.abspath(filename)})
+        except (NotImage.DoesNotExist, NotImage.MultipleDocumentsReturned):
+            return False
+        if not sniff and i.attributes.get('reason', 'sniff') == 'sniff':
+            return False
+        return i.created >= os.stat(filename).st_mtime
+
+    @classmethod
+    def save_non_image(cls, filename, reason, mtime=None):
+        """
+        Records that this file could not be read as an image, until it is modified. The reason is 'sniff' when its
+        first bytes gave it away or 'decode' when the image library didn't recognize it.
+        """
+        from documents import NotImage
+        name = os.path.abspath(filename)
+        cls.backend_lock.acquire()
+        cls.store().filter(NotImage, {'name': name}).delete()
+        cls.store().save(NotImage({'name': name, 'reason': reason,
+                                   'created': mtime or os.stat(filename).st_mtime}))
+        cls.uncommitted_count += 1
+        cls.backend_lock.release()
+        cls.checkpoint()
+
+    @classmethod
+    def is_quarantined(cls, filename):
+        """
+        Check the database for a record that this file, as it is now, went over one of the limits while being hashed.
+        It stays quarantined only while that limit is set the same or stricter than when it went over.
+        """
+        from documents import Quarantine
+        try:
+            i = cls.store().get(Quarantine, {'name': os.path.abspath(filename)})
+        except (Quarantine.DoesNotExist, Quarantine.MultipleDocumentsReturned):
+            return False
+        current = {'timeout': cls.task_timeout, 'pixels': cls.max_pixels, 'memory': cls.max_memory}
+        limit = current.get(i.attributes.get('limit'))
+        if not limit or limit > i.attributes.get('value'):
+            return False
+        return i.created >= os.stat(filename).st_mtime
+
+    @classmethod
+    def quarantine(cls, filename, reason, limit, value, mtime=None):
+        """
+        Records that this file went over a limit while being hashed so later runs with the same limit skip it, until
+        it is modified
+        """
+        from documents import Quarantine
+        print "Quarantined %s (%s)" % (filename, reason)
+        try:
+            mtime = mtime or os.stat(filename).st_mtime
+        except OSError:
+            return
+        name = os.path.abspath(filename)
+        cls.backend_lock.acquire()
+        cls.store().filter(Quarantine, {'name': name}).delete()
+        cls.store().save(Quarantine({'name': name, 'reason': reason, 'limit': limit, 'value': value, 'created': mtime}))
+        cls.uncommitted_count += 1
+        cls.backend_lock.release()
+        cls.checkpoint()
+
+    @classmethod
+    def compact(cls, seen=None, roots=()):
+        """
+        Garbage collects the cache and rewrites it without the churn left behind by deleted records.
 
-        cls.saved_hashes[key] = value
+        Records are dropped when their file no longer exists, or when it is under one of the scanned roots but wasn't
+        in the set of paths seen by the scan. Only the newest record is kept for each path. Records are named by
+        absolute path, so the cache can be cleaned from any directory, and relative names left by older versions are
+        dropped since nothing looks them up anymore.
+        """
+        from cache import CacheBackend
+        from documents import ImageHash, NotImage, Quarantine
+        cls.checkpoint(force=True)
+        store = cls.store()
+        size_before = directory_size(cls.cache_path)
+
+        # Only paths inside one of the scanned folders can be judged by whether the scan saw them
+        roots = [os.path.abspath(root).rstrip(os.sep) for root in roots]
+        if seen is not None:
+            seen = set(os.path.abspath(name) for name in seen)
+
+        def unseen(name):
+            if seen is None:
+                return False
+            path = os.path.abspath(name)
+            return path not in seen and any(path == root or path.startswith(root + os.sep) for root in roots)
+
+        # Keep the newest live record for each path
+        kept, dropped = dict(), 0
+        for doc_class in (ImageHash, NotImage, Quarantine):
+            newest = dict()
+            for record in store.filter(doc_class, {}):
+                name = record.name
+                if not os.path.isabs(name) or unseen(name) or not os.path.exists(name):
+                    dropped += 1
+                    continue
+                if name in newest:
+                    dropped += 1
+                    if newest[name].created >= record.created:
+                        continue
+                newest[name] = record
+            kept[doc_class] = newest.values()
+
+        # Time lookups of records that survive, so both stores are measured finding the same hashes
+        sample = [r.name for r in islice(kept[ImageHash], 1000)]
+        started = time.time()
+        for name in sample:
+            cls.lookup_file(name)
+        lookup_before = time.time() - started
+
+        # Write the survivors to a fresh store and swap it in place of the old one. The old store is only deleted once
+        # the new one is in place, and store() puts it back if we die in between.
+        compact_path, old_path = cls.cache_path + '.compact', cls.cache_path + '.old'
+        shutil.rmtree(compact_path, ignore_errors=True)
+        shutil.rmtree(old_path, ignore_errors=True)
+        compacted = CacheBackend(compact_path)
+        for doc_class, records in kept.items():
+            compacted.create_index(doc_class, 'name')
+            for record in records:
+                compacted.save(doc_class(dict(record.attributes)))
+        compacted.commit()
+        cls.backend_lock.acquire()
+        os.rename(cls.cache_path, old_path)
+        os.rename(compact_path, cls.cache_path)
+        cls.persistent_store = None
+        cls.backend_lock.release()
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        size_after = directory_size(cls.cache_path)
+        # The first lookup loads the indexes of the new store, leave it out of the timing like the warm old store
+        if sample:
+            cls.lookup_file(sample[0])
+        started = time.time()
+        for name in sample:
+            cls.lookup_file(name)
+        lookup_after = time.time() - started
+
+        print "Cache cleanup removed %d records, %d left" % (dropped, sum(len(r) for r in kept.values()))
+        print "Cache size went from %.1f MB to %.1f MB, %.1f MB reclaimed" % (
+            size_before / 1048576., size_after / 1048576., (size_before - size_after) / 1048576.)
+        if sample and lookup_after > 0:
+            print "Lookups went from %.2f ms to %.2f ms each, %.1fx faster" % (
+                lookup_before * 1000 / len(sample), lookup_after * 1000 / len(sample), lookup_before / lookup_after)
+
+    @classmethod
+    def cached_hash(cls, filename):
+        """
+        Finds the hash of a file in the cache, under any of the paths that point to it, if the file hasn't been
+        modified since it was hashed
+        """
+        identity = file_identity(filename)
+        for name in cls.file_aliases.get(identity, [filename]):
+            i = cls.lookup_file(name)
+            if i and i.attributes.get('version') == cls.hash_version:
+                # Check if image has not been modified since last hash
+                try:
+                    if i.created >= os.stat(filename).st_mtime:
+                        return i.hash, i.variants
+                except OSError:
+                    # File went away since it was listed
+                    return None
+        return None
+
+    @classmethod
+    def hash_file(cls, filename):
+        """
+        Worker entry point. Any file that can't be hashed comes back as None so the parent always hears back about it,
+        files the image library doesn't recognize come back as NOT_AN_IMAGE and files that go over the time, pixel or
+        memory limits come back as Quarantined.
+        """
+        from PIL import Image
+        signal.alarm(cls.task_timeout)
+        try:
+            announce_task(filename)
+            return cls.hash(filename, filename)
+        except UnidentifiedImage:
+            return NOT_AN_IMAGE
+        except TaskTimeout:
+            return Quarantined('took longer than %d seconds' % cls.task_timeout, 'timeout', cls.task_timeout)
+        except MemoryError:
+            return Quarantined('ran out of memory', 'memory', cls.max_memory)
+        except (ImageTooLarge, getattr(Image, 'DecompressionBombError', ImageTooLarge)):
+            return Quarantined('too many pixels', 'pixels', cls.max_pixels)
+        except Exception:
+            return None
+        finally:
+            signal.alarm(0)
+
+    @staticmethod
+    def orient(image, source=None):
+        """
+        Turns the image the way the camera meant it to be shown, according to the EXIF orientation of the file it was
+        decoded from, which is the image itself unless a scaled down copy is being turned
+        """
+        from PIL import Image
+        try:
+            orientation = (source or image)._getexif().get(EXIF_ORIENTATION)
+        except Exception:
+            # Not a format with EXIF data, or no EXIF data at all
+            return image
+        transposes = {
+            2: [Image.FLIP_LEFT_RIGHT],
+            3: [Image.ROTATE_180],
+            4: [Image.FLIP_TOP_BOTTOM],
+            5: [Image.FLIP_LEFT_RIGHT, Image.ROTATE_90],
+            6: [Image.ROTATE_270],
+            7: [Image.FLIP_LEFT_RIGHT, Image.ROTATE_270],
+            8: [Image.ROTATE_90],
+        }
+        for method in transposes.get(orientation, []):
+            image = image.transpose(method)
+        return image
 
     @classmethod
     def hash(cls, image, filename=None):
+        """
+        Returns the average hash of the image along with the hashes of its 8x8 grid in all 8 orientations, so rotated
+        and mirrored copies can be matched without decoding the file again
+        """
+        from PIL import Image
+        identity = file_identity(filename) if filename else None
         # Return already calculated hash in memory
-        if cls.saved_hashes.get(filename, None):
-            return cls.saved_hashes.get(filename, None)
+        if cls.saved_hashes.get(identity, None):
+            return cls.saved_hashes.get(identity, None)
         # Return already calculated hash in db
-        i = cls.lookup_file(filename)
-        if i:
-            # Check if image has not been modified since last hash
-            if i.created >= os.stat(filename).st_mtime:
-                return i.hash
+        if filename:
+            cached = cls.cached_hash(filename)
+            if cached is not None:
+                return cached
         if not isinstance(image, Image.Image):
             # Check if file is an image
             try:
-                image = Image.open(image)
-            except IOError:
+                image = Image.open(buffered_read(image))
+            except IOError as e:
+                # Only a file no image plugin recognizes is not an image, anything else is a read error
+                if 'cannot identify image file' in str(e):
+                    raise UnidentifiedImage()
                 return None
-        image = image.resize((8, 9), Image.ANTIALIAS).convert('L')
+        # Opening only reads the header, refuse to decode decompression bombs
+        if cls.max_pixels and image.size[0] * image.size[1] > cls.max_pixels:
+            raise ImageTooLarge()
+        # Decode and scale down once, JPEGs can skip most of the decoding work at a reduced size, and turn only the
+        # thumbnail that both grids are taken from
+        image.draft('L', THUMBNAIL_SIZE)
+        thumbnail = cls.orient(image.convert('L').resize(THUMBNAIL_SIZE, Image.ANTIALIAS), image)
+        grid = thumbnail.resize((8, 8), Image.ANTIALIAS)
+        image = thumbnail.resize((8, 9), Image.ANTIALIAS)
         avg = reduce(lambda x, y: x + y, image.getdata()) / 64.
         avhash = reduce(lambda x, (y, z): x | (z << y),
                         enumerate(map(lambda i: 0 if i < avg else 1, image.getdata())),
                         0)
-        return avhash
+        return avhash, dihedral_hashes(list(grid.getdata()))
 
     @staticmethod
     def hamming_score(hash1, hash2):
@@ -134,22 +454,83 @@ def main(*args, **kwargs):
     # Identified pairs of related images
     similar_pairs = list()
 
-    # Find all files under directory
+    # Paths that point to a file we already found, these are hard links and need no comparison
+    linked_files = list()
+
+    # Open the cache before forking so the workers inherit it instead of each opening their own
+    ImageUtils.cache_path = os.path.expanduser(cache)
+    ImageUtils.checkpoint_records = checkpoint_records
+    ImageUtils.checkpoint_seconds = checkpoint_seconds
+    ImageUtils.task_timeout = task_timeout
+    ImageUtils.max_pixels = max_pixels
+    ImageUtils.max_memory = max_memory
+    ImageUtils.store()
+
+    if gc_only:
+        ImageUtils.compact()
+        return
+
+    # Find all files under directory, turning away anything that isn't an image before it reaches the workers
+    file_filter = FileFilter(include=include, exclude=exclude, extensions=extensions, sniff=sniff)
     images = []
+    to_hash = []
+    represented = dict()
+    rejected = set()
+    quarantined = set()
+    walked = set()
     for d in (start_dir, compare_to):
         if d:
             for root, dirnames, filenames in os.walk(d):
-                for filename in fnmatch.filter(filenames, '*.*'):
-                    # Don't include any thumbnail or other junk from iPhoto/Photos
-                    if not '.photoslibrary' in root or 'Masters' in root:
-                        if not str(filename).startswith('.') and not str(filename).endswith('.CR2'):
-                            images.append(os.path.join(root, filename))
+                for filename in filenames:
+                    if not file_filter.accepts_name(root, filename):
+                        continue
+                    image_path = os.path.join(root, filename)
+                    walked.add(image_path)
+                    identity = file_identity(image_path)
+                    if identity is None or identity in rejected:
+                        continue
+                    # Only the first path to each file gets hashed and compared
+                    aliases = ImageUtils.file_aliases.setdefault(identity, [])
+                    if image_path in aliases:
+                        continue
+                    aliases.append(image_path)
+                    if len(aliases) > 1:
+                        linked_files.append(LinkedRecord(aliases[0], image_path))
+                        # Between two folders the file still needs comparing from each side, so the first path to it
+                        # in each folder is kept for the comparison. It shares the hash of the first path overall.
+                        if compare_to and identity in represented and d not in represented[identity]:
+                            represented[identity].add(d)
+                            images.append(image_path)
+                        continue
+                    try:
+                        if ImageUtils.is_known_non_image(image_path, sniff):
+                            rejected.add(identity)
+                            continue
+                        if ImageUtils.is_quarantined(image_path):
+                            quarantined.add(identity)
+                            continue
+                        if not file_filter.accepts_content(image_path):
+                            ImageUtils.save_non_image(image_path, 'sniff')
+                            rejected.add(identity)
+                            continue
+                    except OSError:
+                        # File went away since it was listed
+                        continue
+                    represented[identity] = set([d])
+                    images.append(image_path)
+                    to_hash.append(image_path)
 
     file_count = len(images)
     if not compare_to:
         print "%d files to process in %s" % (file_count, start_dir)
     else:
         print "Comparing %d images between %s and %s" % (file_count, start_dir, compare_to)
+    if linked_files:
+        print "%d hard links to files already found will not be hashed again" % len(linked_files)
+    if rejected:
+        print "%d files are not images and were skipped" % len(rejected)
+    if quarantined:
+        print "%d files were quarantined by earlier runs and were skipped" % len(quarantined)
 
     if file_count == 0:
         print "No images found"
@@ -158,55 +539,126 @@ def main(*args, **kwargs):
     # Prehash
     print "Please wait for initial image scan to complete..."
 
+    # When resuming, files already finalized in the cache are loaded here and never sent to the workers
+    pending = to_hash
+    if resume:
+        pending = []
+        for image_path in to_hash:
+            cached = ImageUtils.cached_hash(image_path)
+            if cached is None:
+                pending.append(image_path)
+            else:
+                ImageUtils.saved_hashes[file_identity(image_path)] = cached
+        print "Resuming, %d of %d files were already hashed" % (len(to_hash) - len(pending), len(to_hash))
+
+    # Files that vanished since the walk are dropped here, so progress only counts tasks that will really be sent
+    pending = schedule_io(pending, io_order)
+
+    # Limit how many workers can read from each disk at once, independent of how many are decoding
+    readers = dict()
+    if io_readers:
+        for identity in ImageUtils.file_aliases:
+            readers.setdefault(identity[0], Semaphore(io_readers))
+
+    # Machine readable progress goes to a file or an inherited file descriptor, one JSON event per line
+    progress_stream = None
+    if progress_fd is not None:
+        progress_stream = os.fdopen(progress_fd, 'w')
+    elif progress_file:
+        progress_stream = open(os.path.expanduser(progress_file), 'a')
+    progress = ProgressTracker(len(pending), stream=progress_stream)
+
+    # When autotuning, only as many tasks as the tuner currently allows are handed to the pool at once
+    limiter = ConcurrencyLimit(min(cpus, cpu_count())) if autotune else None
+
+    def task_done(kind):
+        progress.task_done(kind)
+        if limiter:
+            limiter.release()
+
+    # Workers stuck on a file past the time limit are killed and the file quarantined
+    watchdog = None
+    if task_timeout:
+        def give_up(path):
+            ImageUtils.quarantine(path, 'worker hung for more than %d seconds' % (task_timeout * 2),
+                                  'timeout', task_timeout)
+            task_done('quarantined')
+        watchdog = TaskWatchdog(task_timeout, give_up)
+        watchdog.start()
+
+    def task_finished(value, key):
+        if watchdog is None or watchdog.finish(key):
+            task_done(ImageUtils.save_hash(key, value))
+
     # Create a worker pool to hash the images over multiple cpus
-    worker_pool = Pool(processes=cpus, initializer=init_worker, maxtasksperchild=100)
-    worker_results = []
+    worker_pool = Pool(processes=cpus, initializer=init_worker,
+                       initargs=(readers, watchdog.starts if watchdog else None, max_memory * 1048576),
+                       maxtasksperchild=100)
 
     # Cache all the image hashes ahead of time so user can see progress
-    for idx, image_path in enumerate(images):
-
-        # Don't process last image as it will not have anything to compare against
-        if idx < file_count:
-            new_callback_function = partial(lambda x, key: ImageUtils.save_hash(key, x), key=image_path)
-            worker_results.append(worker_pool.apply_async(MethodProxy(ImageUtils, ImageUtils.hash), [image_path, image_path],
-                                    callback=new_callback_function))
+    def dispatch():
+        for image_path in pending:
+            if limiter:
+                limiter.acquire()
+            new_callback_function = partial(task_finished, key=image_path)
+            worker_pool.apply_async(MethodProxy(ImageUtils, ImageUtils.hash_file), [image_path],
+                                    callback=new_callback_function)
+
+    # The autotuner needs the tasks fed in from the side while it watches the throughput
+    tuner = None
+    if autotune:
+        feeder = threading.Thread(target=dispatch)
+        feeder.daemon = True
+        feeder.start()
+        tuner = Autotuner(limiter, progress, cpus)
+        tuner.start()
+    else:
+        dispatch()
 
-    # This block basically prints out the progress until hashing is done and allows graceful exit if user quits
+    # This block prints out the progress as workers finish until hashing is done and allows graceful exit if user quits
     try:
-        done, elapsed, total, started = 0, 0, len(worker_results), time.time()
+        progress.wait()
         worker_pool.close()
-        while True:
-            done = sum(r.ready() for r in worker_results)
-            elapsed = time.time() - started
-            rate = int(ImageUtils.new_hash_count / elapsed)
-            eta = int((total - done) / float(rate)) if done > 0 and rate > 0 else None
-            print_progress(int(float(done)/total*100), rate, eta)
-            # if all(r.ready() for r in worker_results):
-            if done == total:
-                print "Hashing completed"
-                break
-            time.sleep(1)
+        print "Hashing completed"
+        if tuner:
+            tuner.report()
     except (KeyboardInterrupt, SystemExit):
         print '\n'
         print "Caught KeyboardInterrupt, terminating workers"
         worker_pool.terminate()
         worker_pool.join()
-        ImageUtils.persistent_store.commit()
+        ImageUtils.checkpoint(force=True)
         exit(1)
     else:
+        # Tasks of killed workers never finish, so the pool can't wait for them
+        if watchdog and watchdog.killed:
+            worker_pool.terminate()
         worker_pool.join()
-        ImageUtils.persistent_store.commit()
+        ImageUtils.checkpoint(force=True)
+    finally:
+        if watchdog:
+            watchdog.stop()
+        if tuner:
+            tuner.stop()
+
+    if auto_gc:
+        ImageUtils.compact(seen=walked, roots=[d for d in (start_dir, compare_to) if d])
 
     if only_index:
         return
 
     # Comparison
+    from tqdm import tqdm
     print ""
     print "Comparing the images..."
 
     target_dir1 = os.path.expanduser(start_dir)
     target_dir2 = os.path.expanduser(compare_to) if compare_to else None
 
+    # Every hash is in memory by now, files that failed to hash are simply missing
+    identities = [file_identity(image_path) for image_path in images]
+    fingerprints = [ImageUtils.saved_hashes.get(identity) for identity in identities]
+
     # Compare each image to every other image
     for idx, image_path in enumerate(tqdm(images)):
 
@@ -214,31 +666,38 @@ def main(*args, **kwargs):
         if idx == file_count - 1:
             continue
 
-        hash1 = ImageUtils.hash(image_path, image_path)
+        fingerprint1 = fingerprints[idx]
 
-        if not hash1:
+        if not fingerprint1:
             continue
 
+        hash1, variants1 = fingerprint1
+
         # Compare to all images following
         for jdx in xrange(idx + 1, len(images)):
             image_path2 = images[jdx]
 
-            # Skip same image paths if it happens
-            if image_path == image_path2:
-                continue
-
             # If comparing two directories instead of one to itself, then check the images belong to different parents
             if compare_to and any([all([str(image_path).startswith(target_dir1), str(image_path2).startswith(target_dir1)]),
                                    all([str(image_path).startswith(target_dir2), str(image_path2).startswith(target_dir2)])]):
                 continue
 
-            hash2 = ImageUtils.hash(image_path2, image_path2)
+            # Two paths to the same file are already reported as a hard link
+            if identities[jdx] == identities[idx]:
+                continue
+
+            fingerprint2 = fingerprints[jdx]
 
-            if not hash2:
+            if not fingerprint2:
                 continue
 
-            # Compute the similarity values
-            dist = ImageUtils.hamming_score(hash1, hash2)
+            hash2, variants2 = fingerprint2
+
+            # Compute the similarity values, against the closest orientation of the first image if asked to
+            if orientation_invariant:
+                dist = min(ImageUtils.hamming_score(variant, variants2[0]) for variant in variants1)
+            else:
+                dist = ImageUtils.hamming_score(hash1, hash2)
             similarity = (64 - dist) * 100 / 64
 
             if not inverse:
@@ -249,7 +708,7 @@ def main(*args, **kwargs):
                     similar_pairs.append(OutputRecord(image_path, image_path2, dist, similarity))
 
     # Print the results
-    outputter_for_format(output).output(similar_pairs)
+    outputter_for_format(output).output(similar_pairs, linked_files)
 
     print '\n'
 
@@ -264,6 +723,25 @@ if __name__ == '__main__':
         'only_index': False,
         'compare_to': None,
         'inverse': False,
+        'io_order': IOOrder.WALK,
+        'io_readers': 0,
+        'cache': 'hashes.db',
+        'checkpoint_records': 1000,
+        'checkpoint_seconds': 300,
+        'resume': False,
+        'orientation_invariant': False,
+        'progress_file': None,
+        'progress_fd': None,
+        'include': None,
+        'exclude': None,
+        'extensions': None,
+        'sniff': True,
+        'gc_only': False,
+        'auto_gc': False,
+        'task_timeout': 120,
+        'max_pixels': 150000000,
+        'max_memory': 0,
+        'autotune': False,
     }
     locals().update(defaults)
 
@@ -271,8 +749,13 @@ if __name__ == '__main__':
 
     parser.add_argument('-c', '--confidence', dest='confidence_threshold', type=int, default=defaults['confidence_threshold'],
                         help='at what percent (1-100) similarity should photos be flagged (default: %(default)s)')
-    parser.add_argument('--cpus', type=int, default=defaults['cpus'],
-                        help='override number of cpu cores to use, default is to utilize all of them (default: %(default)s)')
+    parser.add_argument('--cpus', type=int,
+                        help='override number of cpu cores to use, default is to utilize all of them (default: %d)' %
+                             defaults['cpus'])
+    parser.add_argument('--autotune', action='store_true',
+                        help='keep adjusting how many workers hash at once to get the most photos per second, ' +
+                             'starting from the number of cores and going up to --cpus, or to %d workers per core ' %
+                             MAX_WORKERS_PER_CPU + 'without it so scans waiting on slow disks can use more')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-d', '--directory', dest='start_dir', type=str, metavar='DIR',
                        help='folder to start looking for photos')
@@ -288,6 +771,52 @@ if __name__ == '__main__':
                        help='only index the photos and skip comparison and output steps', action='store_true')
     parser.add_argument('--inverse', action='store_true',
                         help='instead of picking out duplicates, identify photos that are different')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='only look at files whose name matches this pattern, or path if it has a /, ' +
+                             'can be repeated (default: *.*)')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='skip files whose name matches this pattern, or path if it has a /, can be repeated')
+    parser.add_argument('--extensions', metavar='LIST',
+                        help='only look at files with these comma separated extensions, e.g. jpg,png')
+    parser.add_argument('--no-sniff', dest='sniff', action='store_false',
+                        help="don't check the first bytes of each file for known formats that aren't images")
+    parser.add_argument('--orientation-invariant', dest='orientation_invariant', action='store_true',
+                        help='also match copies that were rotated or mirrored')
+    parser.add_argument('--cache', metavar='PATH', default=defaults['cache'],
+                        help='where to keep the cache of image hashes (default: %(default)s)')
+    parser.add_argument('--gc', dest='gc_only', action='store_true',
+                        help='clean up and compact the cache of image hashes, then exit without scanning')
+    parser.add_argument('--auto-gc', dest='auto_gc', action='store_true',
+                        help='clean up and compact the cache after hashing, dropping photos not seen by this scan')
+    parser.add_argument('--timeout', dest='task_timeout', type=int, metavar='SECONDS', default=defaults['task_timeout'],
+                        help='quarantine photos that take longer than this to hash, 0 to disable ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--max-pixels', dest='max_pixels', type=int, metavar='N', default=defaults['max_pixels'],
+                        help='quarantine photos with more pixels than this, 0 to disable (default: %(default)s)')
+    parser.add_argument('--max-memory', dest='max_memory', type=int, metavar='MB',
+                        help='quarantine photos that need more than this much extra memory on top of what a ' +
+                             'worker starts with, Linux only (default: unlimited)')
+    parser.add_argument('--checkpoint-every', dest='checkpoint_records', type=int, metavar='N',
+                        default=defaults['checkpoint_records'],
+                        help='commit new hashes to the cache after this many records, 0 to disable. Every ' +
+                             'commit rewrites the whole cache index, so small values slow down large libraries ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_seconds', type=int, metavar='SECONDS',
+                        default=defaults['checkpoint_seconds'],
+                        help='commit new hashes to the cache after this many seconds, 0 to disable ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip photos that were already hashed by an earlier, possibly interrupted, run')
+    parser.add_argument('--progress-file', dest='progress_file', metavar='PATH',
+                        help='append hashing progress to this file as one JSON event per line')
+    parser.add_argument('--progress-fd', dest='progress_fd', type=int, metavar='FD',
+                        help='write hashing progress to this open file descriptor as one JSON event per line')
+    parser.add_argument('--io-order', dest='io_order', metavar='ORDER', choices=IOOrder.cmd_choices(),
+                        help='order in which photos are read, inode or extent order avoids seeking on spinning disks ' +
+                             '(choices: %(choices)s)')
+    parser.add_argument('--io-readers', dest='io_readers', type=int, metavar='N',
+                        help='max number of workers reading from the same disk at once, separate from --cpus ' +
+                             '(default: unlimited)')
 
     args = parser.parse_args()
     if args.confidence_threshold:
@@ -298,6 +827,10 @@ if __name__ == '__main__':
         start_dir = os.path.expanduser("{}/Masters/".format(osx_photoslibrary_location()))
     if args.cpus:
         cpus = args.cpus
+    if args.autotune:
+        autotune = args.autotune
+        if not args.cpus:
+            cpus = cpu_count() * MAX_WORKERS_PER_CPU
     if args.format:
         output = Formats.from_option(args.format)
     if args.index:
@@ -306,6 +839,42 @@ if __name__ == '__main__':
         compare_to = args.compare_to
     if args.inverse:
         inverse = args.inverse
+    if args.include:
+        include = args.include
+    if args.exclude:
+        exclude = args.exclude
+    if args.extensions:
+        extensions = args.extensions.split(',')
+    if not args.sniff:
+        sniff = args.sniff
+    if args.orientation_invariant:
+        orientation_invariant = args.orientation_invariant
+    if args.cache:
+        cache = args.cache
+    if args.gc_only:
+        gc_only = args.gc_only
+    if args.auto_gc:
+        auto_gc = args.auto_gc
+    if args.task_timeout is not None:
+        task_timeout = args.task_timeout
+    if args.max_pixels is not None:
+        max_pixels = args.max_pixels
+    if args.max_memory:
+        max_memory = args.max_memory
+    if args.checkpoint_records is not None:
+        checkpoint_records = args.checkpoint_records
+    if args.checkpoint_seconds is not None:
+        checkpoint_seconds = args.checkpoint_seconds
+    if args.resume:
+        resume = args.resume
+    if args.progress_file:
+        progress_file = args.progress_file
+    if args.progress_fd is not None:
+        progress_fd = args.progress_fd
+    if args.io_order:
+        io_order = IOOrder.from_option(args.io_order)
+    if args.io_readers:
+        io_readers = args.io_readers
 
     main(**locals())
 
@@ -0,0 +1,148 @@
+import threading
+import time
+
+
+# Without --cpus, autotuning may go up to this many workers per core, for scans that wait on disks or the network
+MAX_WORKERS_PER_CPU = 4
+
+
+def cpu_times():
+    """
+    Busy and total CPU time across the machine so far, or None where /proc/stat isn't available
+    """
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except (IOError, ValueError):
+        return None
+    # idle and iowait are the only fields where the cpu isn't doing work
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    return sum(fields) - idle, sum(fields)
+
+
+class ConcurrencyLimit(object):
+    """
+    Semaphore whose size can change while tasks are running, used to vary how many workers are busy without
+    restarting the pool
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.changed = threading.Condition()
+
+    def acquire(self):
+        with self.changed:
+            while self.in_flight >= self.limit:
+                self.changed.wait(1)
+            self.in_flight += 1
+
+    def release(self):
+        with self.changed:
+            self.in_flight -= 1
+            self.changed.notify()
+
+    def set_limit(self, limit):
+        with self.changed:
+            self.limit = limit
+            self.changed.notify_all()
+
+
+class Autotuner(object):
+    """
+    Hill climbs the number of busy workers towards the highest throughput, measured every interval. More workers are
+    only tried while the cpus have room to spare or the last change paid off, so CPU bound scans don't oversubscribe
+    and I/O bound scans can go past the number of cores.
+
+    The rate of every worker count tried is remembered, so the climb settles on the best count instead of stepping
+    off it and back forever. Counts are only tried again once the rate has moved away from what was measured for
+    a couple of intervals in a row, for example when the scan reaches a slower disk.
+    """
+
+    def __init__(self, limiter, progress, cap, interval=5):
+        self.limiter = limiter
+        self.progress = progress
+        self.cap = cap
+        self.interval = interval
+        self.direction = 1
+        self.measured = dict()
+        self.drifted = 0
+        self.best = (0, limiter.limit)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def decide(self, limit, rate, cpu):
+        """
+        Picks the number of workers for the next interval
+        """
+        settled = self.measured.get(limit)
+        if settled is None:
+            self.measured[limit] = rate
+        elif abs(rate - settled) > settled * 0.2:
+            # Start over once the workload itself has changed, not on a single noisy interval
+            self.drifted += 1
+            if self.drifted >= 2:
+                self.measured, self.drifted = {limit: rate}, 0
+        else:
+            self.drifted = 0
+
+        def better(count):
+            return self.measured.get(count, 0) > rate * 1.05
+
+        back, forward = limit - self.direction, limit + self.direction
+        if better(back):
+            # The last change made things worse, go back the other way
+            self.direction = -self.direction
+            return back
+        if 1 <= forward <= self.cap:
+            if better(forward):
+                return forward
+            if forward not in self.measured:
+                if back in self.measured:
+                    # Keep going the same way only while the last step paid off
+                    if rate > self.measured[back] * 1.05:
+                        return forward
+                elif self.direction < 0 or cpu is None or cpu <= 0.9:
+                    # First step, more workers only help while the cpus have room
+                    return forward
+        if 1 <= back <= self.cap and back not in self.measured:
+            self.direction = -self.direction
+            return back
+        return limit
+
+    def run(self):
+        done, times = self.progress.done, cpu_times()
+        while not self.stopped.wait(self.interval):
+            new_done, new_times = self.progress.done, cpu_times()
+            rate = (new_done - done) / float(self.interval)
+            cpu = None
+            if times and new_times and new_times[1] > times[1]:
+                cpu = float(new_times[0] - times[0]) / (new_times[1] - times[1])
+            done, times = new_done, new_times
+
+            limit = self.limiter.limit
+            if rate > self.best[0]:
+                self.best = (rate, limit)
+            new_limit = self.decide(limit, rate, cpu)
+
+            cpu_str = '%d%% cpu' % (cpu * 100) if cpu is not None else 'cpu unknown'
+            if new_limit > limit:
+                action = 'raising to %d' % new_limit
+            elif new_limit < limit:
+                action = 'lowering to %d' % new_limit
+            else:
+                action = 'holding'
+            print "Autotune: %d workers, %.1f images per second, %s, %s" % (limit, rate, cpu_str, action)
+            self.limiter.set_limit(new_limit)
+
+    def report(self):
+        if self.best[0]:
+            print "Autotune: best was %.1f images per second with %d workers, use --cpus %d to keep it" % (
+                self.best[0], self.best[1], self.best[1])
@@ -0,0 +1,101 @@
+import os
+
+from blitzdb import FileBackend
+from blitzdb.backends.file.serializers import JsonSerializer
+from blitzdb.backends.file.store import Store, TransactionalStore
+
+
+def replace_file(path, data):
+    """
+    Writes a file by renaming a complete copy over it, so a crash leaves either the old or the new contents
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+
+class AtomicStore(Store):
+    """
+    Store whose blobs are never left half written
+    """
+
+    def store_blob(self, blob, key):
+        replace_file(self._get_path_for_key(key), blob)
+        return key
+
+
+class DeferredDeleteStore(TransactionalStore, AtomicStore):
+    """
+    Transactional store that writes new blobs on commit but keeps deleted ones on disk until purge() is called, so
+    the indexes can stop pointing at them first
+    """
+
+    def begin(self):
+        super(DeferredDeleteStore, self).begin()
+        self._purge_cache = set()
+
+    def commit(self):
+        self._purge_cache |= self._delete_cache
+        self._delete_cache = set()
+        super(DeferredDeleteStore, self).commit()
+
+    def purge(self):
+        for key in self._purge_cache:
+            AtomicStore.delete_blob(self, key)
+        self._purge_cache = set()
+
+
+class CacheBackend(FileBackend):
+    """
+    File backend that can be killed at any point of a commit and still be opened afterwards.
+
+    Every blob is written to a temporary file and renamed into place, documents are written before the indexes that
+    point at them and deleted documents are only removed once no index points at them anymore. A commit that was cut
+    short between two indexes of a collection is noticed the next time the cache is opened and the indexes are rebuilt
+    from the primary key index, records of the unfinished commit that didn't make it in are simply missing.
+
+    Each commit still rewrites every index of a collection in full, as the file backend always does.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        super(CacheBackend, self).__init__(path, *args, **kwargs)
+        self.commit_marker = os.path.join(self.path, 'committing')
+
+    @property
+    def StoreClass(self):
+        return DeferredDeleteStore
+
+    @property
+    def IndexStoreClass(self):
+        return AtomicStore
+
+    def save_config(self):
+        replace_file(self._path + '/config.json', JsonSerializer.serialize(self._config))
+
+    def commit(self):
+        open(self.commit_marker, 'wb').close()
+        for collection in self.collections:
+            store = self.get_collection_store(collection)
+            store.commit()
+            for index in self.get_collection_indexes(collection).values():
+                index.commit()
+            store.purge()
+        os.remove(self.commit_marker)
+        self.in_transaction = False
+        self.begin()
+
+    def recover(self, *document_classes):
+        """
+        Rebuilds the indexes of the given documents if the last commit didn't finish
+        """
+        if not os.path.exists(self.commit_marker):
+            return False
+        for cls in document_classes:
+            collection = self.get_collection_for_cls(cls)
+            keys = [key for key in self.indexes[collection] if key != cls.get_pk_name()]
+            self.rebuild_indexes(collection, keys)
+        os.remove(self.commit_marker)
+        return True
@@ -0,0 +1,13 @@
+from blitzdb import Document
+
+
+class ImageHash(Document):
+    pass
+
+
+class NotImage(Document):
+    pass
+
+
+class Quarantine(Document):
+    pass
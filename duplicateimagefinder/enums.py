@@ -19,3 +19,24 @@ class Formats(object):
     @staticmethod
     def cmd_choices():
         return ('human', 'json')
+
+
+class IOOrder(object):
+    """
+    Order in which files are handed to the hashing workers
+    """
+    WALK = 1
+    INODE = 2
+    EXTENT = 3
+
+    @classmethod
+    def from_option(cls, opt):
+        o = str(opt).lower()
+        if o == 'walk': return cls.WALK
+        elif o == 'inode': return cls.INODE
+        elif o == 'extent': return cls.EXTENT
+        else: return cls.WALK
+
+    @staticmethod
+    def cmd_choices():
+        return ('walk', 'inode', 'extent')
@@ -0,0 +1,94 @@
+import fnmatch
+import os
+
+
+# How many bytes at the start of a file are read to recognize its format
+SNIFF_BYTES = 16
+
+# Signatures of common formats that are known not to be images, as (offset, bytes) pairs that must all match.
+# Anything else is let through, Pillow opens plenty of formats without a reliable signature, like TGA.
+NON_IMAGE_SIGNATURES = (
+    ((4, 'ftypqt  '),),                             # QuickTime video
+    ((4, 'ftypisom'),),                             # MP4 video
+    ((4, 'ftypiso2'),),
+    ((4, 'ftypmp41'),),
+    ((4, 'ftypmp42'),),
+    ((4, 'ftypM4V '),),
+    ((4, 'ftypM4A '),),                             # AAC audio
+    ((4, 'ftyp3gp'),),                              # 3GP video
+    ((4, 'ftypavc1'),),
+    ((0, 'RIFF'), (8, 'AVI ')),                     # AVI video
+    ((0, 'RIFF'), (8, 'WAVE')),                     # WAV audio
+    ((0, '\x1a\x45\xdf\xa3'),),                     # Matroska and WebM video
+    ((0, '\x00\x00\x01\xba'),),                     # MPEG video
+    ((0, 'ID3'),),                                  # MP3 audio
+    ((0, 'fLaC'),),                                 # FLAC audio
+    ((0, 'OggS'),),                                 # Ogg audio and video
+    ((0, '%PDF'),),                                 # PDF
+    ((0, 'PK\x03\x04'),),                           # Zip archives
+    ((0, '\x1f\x8b'),),                              # Gzip archives
+    ((0, 'bplist'),),                               # Binary property lists
+)
+
+# Text sidecars start with one of these once leading whitespace is skipped: JSON, and XML like XMP or AAE files
+TEXT_SIDECAR_STARTS = ('{', '[', '<')
+
+# Files that are never worth looking at, hidden files and raw camera files Pillow can't read
+DEFAULT_EXCLUDES = ('.*', '*.CR2')
+
+
+def matches(pattern, filename, path):
+    """
+    Patterns with a path separator are matched against the whole path, others against just the file name
+    """
+    if os.sep in pattern:
+        return fnmatch.fnmatch(path, pattern)
+    return fnmatch.fnmatch(filename, pattern)
+
+
+class FileFilter(object):
+    """
+    Decides which files found on disk are sent to the workers, so videos, sidecars and other junk are turned away
+    before they cost a task, an open attempt and a failed decode.
+    """
+
+    def __init__(self, include=None, exclude=None, extensions=None, sniff=True):
+        self.include = include or ['*.*']
+        self.exclude = list(DEFAULT_EXCLUDES) + list(exclude or [])
+        self.extensions = set(e.lower().lstrip('.') for e in extensions) if extensions else None
+        self.sniff = sniff
+
+    def accepts_name(self, root, filename):
+        """
+        Checks the rules that only need the name of the file
+        """
+        # Don't include any thumbnail or other junk from iPhoto/Photos
+        if '.photoslibrary' in root and not 'Masters' in root:
+            return False
+        path = os.path.join(root, filename)
+        if not any(matches(pattern, filename, path) for pattern in self.include):
+            return False
+        if any(matches(pattern, filename, path) for pattern in self.exclude):
+            return False
+        if self.extensions is not None and os.path.splitext(filename)[1].lower().lstrip('.') not in self.extensions:
+            return False
+        return True
+
+    def accepts_content(self, path):
+        """
+        Checks the first few bytes of the file against the signatures of formats known not to be images. Files that
+        can't be read are let through, the workers will report them as failed rather than as not being images.
+        """
+        if not self.sniff:
+            return True
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(SNIFF_BYTES)
+        except IOError:
+            return True
+        if not header:
+            return False
+        if header.lstrip('\xef\xbb\xbf \t\r\n').startswith(TEXT_SIDECAR_STARTS):
+            return False
+        return not any(all(header[offset:offset + len(magic)] == magic for offset, magic in signature)
+                       for signature in NON_IMAGE_SIGNATURES)
@@ -9,3 +9,10 @@ class OutputRecord(object):
         self.image2 = image2
         self.hamming_score = hamming_score
         self.similarity_pct = similarity_pct
+
+class LinkedRecord(object):
+    image1, image2 = None, None
+
+    def __init__(self, image1, image2):
+        self.image1 = image1
+        self.image2 = image2
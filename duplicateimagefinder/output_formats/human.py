@@ -5,10 +5,10 @@ import base
 
 
 class HumanFormat(base.BaseFormatter):
-    def output(self, data):
+    def output(self, data, linked=None):
         assert type(data) is ListType, "data is not a list"
 
-        if not len(data):
+        if not len(data) and not linked:
             print "No results."
             return
 
@@ -19,3 +19,11 @@ class HumanFormat(base.BaseFormatter):
                 similar.image1, similar.similarity_pct, similar.image2
             ))
             sys.stdout.flush()
+
+        # List the paths that are hard links to the same file, these are already deduplicated on disk
+        for link in linked or []:
+            assert isinstance(link, base.LinkedRecord), "record is not instance of LinkedRecord"
+            sys.stdout.old_write("%s is a hard link to %s (already deduplicated)\n" % (
+                link.image2, link.image1
+            ))
+            sys.stdout.flush()
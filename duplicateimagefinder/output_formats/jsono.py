@@ -6,7 +6,7 @@ import base
 
 
 class JsonFormat(base.BaseFormatter):
-    def output(self, data):
+    def output(self, data, linked=None):
         assert type(data) is ListType, "data is not a list"
 
         # List the images that are similar to each other
@@ -16,4 +16,10 @@ class JsonFormat(base.BaseFormatter):
             sys.stdout.old_write(json.dumps({'image1': similar.image1, 'image2': similar.image2,
                               'similarity': similar.similarity_pct}) + ',')
             sys.stdout.flush()
+        # Hard links are flagged instead of given a similarity, they are the same file on disk
+        for link in linked or []:
+            assert isinstance(link, base.LinkedRecord), "record is not instance of LinkedRecord"
+            sys.stdout.old_write(json.dumps({'image1': link.image1, 'image2': link.image2,
+                              'hardlink': True}) + ',')
+            sys.stdout.flush()
         sys.stdout.old_write(']')
@@ -0,0 +1,84 @@
+from collections import deque
+import json
+import threading
+import time
+
+from utils import print_progress
+
+
+class ProgressTracker(object):
+    """
+    Counts hashing tasks as their callbacks come in, so progress never has to poll the pool. Cache hits and new hashes
+    are counted separately and the rate is smoothed over a moving window of recent completions.
+    """
+
+    def __init__(self, total, window=10, interval=1, stream=None):
+        self.total = total
+        self.window = window
+        self.interval = interval
+        self.stream = stream
+        self.counts = {'new': 0, 'cached': 0, 'failed': 0, 'quarantined': 0}
+        self.completions = deque()
+        self.started = time.time()
+        self.finished = threading.Condition()
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def task_done(self, kind):
+        """
+        Records a finished task, called from the pool's result thread
+        """
+        with self.finished:
+            self.counts[kind] += 1
+            self.completions.append(time.time())
+            if self.done >= self.total:
+                self.finished.notify()
+
+    def rate(self):
+        """
+        Tasks finished per second over the last few seconds
+        """
+        now = time.time()
+        with self.finished:
+            while self.completions and self.completions[0] < now - self.window:
+                self.completions.popleft()
+            recent = len(self.completions)
+        span = min(self.window, now - self.started)
+        return recent / span if span > 0 else 0
+
+    def emit(self, event, **fields):
+        """
+        Writes one line of JSON describing the run to the progress stream, if there is one
+        """
+        if self.stream is None:
+            return
+        fields.update({'event': event, 'time': time.time()})
+        self.stream.write(json.dumps(fields) + '\n')
+        self.stream.flush()
+
+    def report(self):
+        """
+        Redraws the progress bar and writes a progress event
+        """
+        done, rate = self.done, self.rate()
+        eta = int((self.total - done) / rate) if rate > 0 else None
+        print_progress(int(float(done) / self.total * 100) if self.total else 100, int(rate), eta)
+        self.emit('progress', done=done, total=self.total, rate=round(rate, 2), eta=eta,
+                  elapsed=round(time.time() - self.started, 2), **self.counts)
+
+    def wait(self):
+        """
+        Reports progress once per interval until every task has finished
+        """
+        self.emit('start', total=self.total)
+        while True:
+            with self.finished:
+                if self.done < self.total:
+                    # A timeout keeps Ctrl-C working while we wait
+                    self.finished.wait(self.interval)
+            self.report()
+            if self.done >= self.total:
+                break
+        self.emit('finish', total=self.total, elapsed=round(time.time() - self.started, 2), **self.counts)
@@ -1,15 +1,39 @@
 import fnmatch
+import io
+from itertools import izip_longest
 from multiprocessing import Lock
 import os
+import resource
 import signal
+import struct
 import sys
+import threading
+import time
+
+from enums import IOOrder
+
+
+# ioctl request for the physical extent map of a file on Linux, and extent flags meaning the location isn't known yet
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_EXTENT_UNKNOWN = 0x2 | 0x4
+
+# EXIF tag holding how the camera was rotated when the photo was taken
+EXIF_ORIENTATION = 274
+# Images are scaled down to this size once before the hash grids are taken from them
+THUMBNAIL_SIZE = (64, 64)
+
+# Per device semaphores limiting how many workers read from a disk at once, set in each worker by init_worker
+device_readers = dict()
+
+# Queue each worker announces the file it starts on to, so stuck workers can be found. Set by init_worker.
+task_starts = None
 
 
 def hijack_print():
     """
-    Makes the built in print safe for use by multiple processes
+    Makes the built in print safe for use by multiple threads and stamps the time at the start of each line
     """
-    stdout_lock = Lock()
+    stdout_lock = threading.Lock()
 
     from datetime import datetime as dt
 
@@ -17,19 +41,24 @@ def hijack_print():
 
     class F:
         nl = True
+        # Set while a line written with old_write, like the progress bar, hasn't been finished
+        partial = False
 
         def old_write(self, x):
             old_f.write(x)
+            self.partial = not x.endswith('\n')
 
         def write(self, x):
-            stdout_lock.acquire()
-            if not x or x == '\n' or x == '' or len(x) == 0:
+            if not x:
+                return
+            with stdout_lock:
+                if self.partial and not x.startswith('\n'):
+                    old_f.write('\n')
+                self.partial = False
+                if self.nl and x != '\n':
+                    old_f.write('%s> ' % str(dt.now()))
                 old_f.write(x)
-                self.nl = True
-            else:
-                old_f.write('%s> %s' % (str(dt.now()), x))
-                self.nl = False
-            stdout_lock.release()
+                self.nl = x.endswith('\n')
 
         def flush(self):
             old_f.flush()
@@ -37,11 +66,126 @@ def hijack_print():
     sys.stdout = F()
 
 
-def init_worker():
+def dihedral_permutations(size):
+    """
+    For each of the 8 rotations and mirror images of a square grid, the source index of every cell. The first one is
+    the grid as is.
+    """
+    edge = size - 1
+    transforms = (
+        lambda x, y: (x, y),
+        lambda x, y: (edge - x, y),
+        lambda x, y: (x, edge - y),
+        lambda x, y: (edge - x, edge - y),
+        lambda x, y: (y, x),
+        lambda x, y: (edge - y, x),
+        lambda x, y: (y, edge - x),
+        lambda x, y: (edge - y, edge - x),
+    )
+    permutations = []
+    for transform in transforms:
+        permutation = []
+        for y in xrange(size):
+            for x in xrange(size):
+                src_x, src_y = transform(x, y)
+                permutation.append(src_y * size + src_x)
+        permutations.append(permutation)
+    return permutations
+
+
+DIHEDRAL_PERMUTATIONS = dihedral_permutations(8)
+
+
+def dihedral_hashes(pixels):
+    """
+    Average hashes of an 8x8 grayscale grid in all 8 orientations, computed from the one set of pixels
+    """
+    avg = sum(pixels) / float(len(pixels))
+    bits = [0 if p < avg else 1 for p in pixels]
+    return [reduce(lambda h, (i, src): h | (bits[src] << i), enumerate(permutation), 0)
+            for permutation in DIHEDRAL_PERMUTATIONS]
+
+
+class TaskTimeout(Exception):
+    """
+    Raised in a worker when hashing a single file takes too long
+    """
+    pass
+
+
+class ImageTooLarge(Exception):
+    """
+    Raised in a worker when an image has more pixels than we are willing to decode
+    """
+    pass
+
+
+class UnidentifiedImage(Exception):
+    """
+    Raised in a worker when the image library doesn't recognize the file as any image format
+    """
+    pass
+
+
+# What a worker returns for a file the image library doesn't recognize, as opposed to one that failed to hash
+NOT_AN_IMAGE = 'not an image'
+
+
+class Quarantined(object):
+    """
+    What a worker returns for a file that was too slow, too large or used too much memory to hash, along with which
+    limit it went over ('timeout', 'pixels' or 'memory') and what that limit was set to
+    """
+    def __init__(self, reason, limit, value):
+        self.reason = reason
+        self.limit = limit
+        self.value = value
+
+
+def raise_task_timeout(signum, frame):
+    raise TaskTimeout()
+
+
+def virtual_memory_size():
+    """
+    Size in bytes of this process' address space, or None where /proc isn't available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def init_worker(readers=None, starts=None, max_memory=0):
     """
-    Ignores Ctrl-C in workers so parent can kill pool
+    Ignores Ctrl-C in workers so parent can kill pool, and applies the per worker limits
     """
+    global task_starts
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, raise_task_timeout)
+    if readers:
+        device_readers.update(readers)
+    task_starts = starts
+    # The address space limit covers everything inherited from the parent too, so it is given as headroom on top.
+    # The image library is loaded first so its shared libraries don't have to fit in the headroom.
+    if max_memory:
+        import PIL.Image
+        current = virtual_memory_size()
+        if current is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (current + max_memory, current + max_memory))
+
+
+def announce_task(path, reading=False):
+    """
+    Lets the parent know which file this worker is about to hash, or that it is reading one while holding a reader
+    slot and mustn't be killed until it lets go of it
+    """
+    if task_starts is not None:
+        task_starts.put((os.getpid(), path, None if reading else time.time()))
 
 
 def print_progress(progress, rate=None, eta=None):
@@ -60,6 +204,95 @@ def print_progress(progress, rate=None, eta=None):
         print ""
 
 
+def file_identity(path):
+    """
+    Identifies the file behind a path by device and inode, so hard links and bind mounts of the same file compare equal
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def physical_offset(path):
+    """
+    Finds where the first extent of a file lives on disk, returns None if the filesystem can't tell us
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    # struct fiemap header asking for a single extent of the whole file, followed by room for that extent
+    request = struct.pack('=QQLLLL', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\0' * 56
+    try:
+        with open(path, 'rb') as f:
+            response = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except (IOError, OSError):
+        return None
+    mapped_extents = struct.unpack_from('=L', response, 20)[0]
+    if not mapped_extents or struct.unpack_from('=L', response, 72)[0] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return struct.unpack_from('=Q', response, 40)[0]
+
+
+def schedule_io(paths, order):
+    """
+    Orders files so each device is read front to back instead of seeking all over the disk. Devices are interleaved
+    so that every disk has work queued at the same time. Files that disappeared since they were found are dropped.
+    """
+    if order == IOOrder.WALK:
+        return list(paths)
+    by_device = dict()
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        position = physical_offset(path) if order == IOOrder.EXTENT else None
+        if position is None:
+            position = st.st_ino
+        by_device.setdefault(st.st_dev, []).append((position, path))
+    queues = [sorted(queue) for queue in by_device.values()]
+    return [path for group in izip_longest(*queues) for position, path in filter(None, group)]
+
+
+def buffered_read(path):
+    """
+    Reads a file into memory while holding its device's reader slot, so decoding happens after the disk is released.
+    Without a reader limit for the device, the path is returned as is and the decoder reads it on its own.
+    """
+    identity = file_identity(path)
+    readers = device_readers.get(identity[0]) if identity else None
+    if readers is None:
+        return path
+    announce_task(path, reading=True)
+    # Waiting behind other readers isn't hashing time, the worker's time limit is paused until it gets its turn
+    remaining = signal.alarm(0)
+    readers.acquire()
+    signal.alarm(remaining)
+    try:
+        with open(path, 'rb') as f:
+            return io.BytesIO(f.read())
+    finally:
+        readers.release()
+        announce_task(path)
+
+
+def directory_size(path):
+    """
+    Total size in bytes of the files under a directory
+    """
+    total = 0
+    for root, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
 def osx_photoslibrary_location():
     """
     Find the OSX Photos.app library location. Don't assume everyone uses default naming.
@@ -0,0 +1,70 @@
+from multiprocessing import Queue
+import os
+from Queue import Empty
+import signal
+import threading
+import time
+
+
+class TaskWatchdog(object):
+    """
+    Keeps track of which file each worker is hashing and kills workers that stay stuck on one, for example inside a
+    decoder where the worker's own time limit can't interrupt it. The pool starts a new worker in its place.
+    Workers reading while holding a per-device reader slot are left alone, killing them would leak the slot for good.
+    """
+
+    def __init__(self, timeout, on_hung):
+        self.timeout = timeout
+        self.on_hung = on_hung
+        self.starts = Queue()
+        self.running = dict()
+        self.finished = set()
+        self.killed = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def finish(self, path):
+        """
+        Marks the file as done, returns False if it was already given up on
+        """
+        with self.lock:
+            if path in self.finished:
+                return False
+            self.finished.add(path)
+            self.running.pop(path, None)
+            return True
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Collect the files workers have started on since we last looked
+            try:
+                while True:
+                    pid, path, started = self.starts.get(timeout=1)
+                    with self.lock:
+                        if path not in self.finished:
+                            self.running[path] = (pid, started)
+            except Empty:
+                pass
+
+            # Workers get twice their own time limit before they are killed from the outside
+            now = time.time()
+            with self.lock:
+                hung = [(path, pid) for path, (pid, started) in self.running.items()
+                        if started is not None and now - started > self.timeout * 2]
+            for path, pid in hung:
+                if not self.finish(path):
+                    continue
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                self.killed += 1
+                self.on_hung(path)